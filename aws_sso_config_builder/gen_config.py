@@ -1,38 +1,67 @@
+import hashlib
 import json
 import logging
+import os
 import re
 import sys
+import tempfile
 import textwrap
 import time
 import webbrowser
-from collections import ChainMap
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import UTC, datetime, timedelta
-from operator import itemgetter
+from itertools import chain
+from pathlib import Path
 
 import boto3
 import click
 import keyring
+import keyring.errors
 from botocore.config import Config
 from rich.console import Console
 from rich.progress import BarColumn, Progress, TaskProgressColumn, TextColumn
 from rich.table import Column
 
-DEFAULT_PROFILE_TEMPLATE = """
+DEFAULT_PROFILE_TEMPLATE = textwrap.dedent(
+    """
     [profile {profile_name}]
     sso_session = {sso_session}
     sso_account_id = {account_id}
     sso_role_name = {role_name}
-"""
+    """
+)
 
-SSO_SESSION_BLOCK = """
+SSO_SESSION_BLOCK = textwrap.dedent(
+    """
     [sso-session {sso_session_name}]
     sso_start_url = {sso_start_url}
     sso_region = us-east-1
-"""
+    """
+)
+
+DEFAULT_REPLACEMENTS = {
+    "_": "-",
+    " ": "-",
+}
+
+# The largest maxResults accepted by ListAccounts and ListAccountRoles
+SSO_LIST_PAGE_SIZE = 100
+
+REGEX_METACHARACTERS = frozenset(".^$*+?{}[]\\|()")
+
+DEFAULT_MAX_PARALLEL_REQUESTS = min(32, (os.cpu_count() or 4) * 5)
+MAX_PARALLEL_DIRECTORIES = 8
+
+SSO_CACHE_DIR = Path.home() / ".aws" / "sso" / "cache"
+ID_CLIENT_PATH = Path.home() / ".aws" / "sso-config-builder" / "id-client.json"
+CLIENT_NAME = "sso-config-generator"
+KEYRING_SERVICE = "aws-sso-oidc"
+KEYRING_USERNAME = "sso-config-generator"
+SSO_CACHE_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 
 VALIDATION_FAIL_EXTRAS = "Expected values in the form 'key=value', got: '{value}'"
 VALIDATION_FAIL_REPLACEMENTS = "Expected values in the form 'pattern,replacement', got: '{value}'"
+VALIDATION_FAIL_REGEX = "Invalid regex replacement '{value}': {error}"
 
 
 def validate_id_client(id_client):
@@ -51,43 +80,146 @@ def validate_id_client(id_client):
         )
         return False
 
+    # clientSecretExpiresAt is already a Unix timestamp
     try:
-        secret_expires = datetime.fromtimestamp(id_client["clientSecretExpiresAt"], UTC)
-        return secret_expires > (datetime.now(UTC) + timedelta(minutes=5))
-    except (TypeError, OverflowError):
+        return id_client["clientSecretExpiresAt"] > time.time() + 300
+    except TypeError:
         return False
 
 
+def load_json_file(path):
+    log = logging.getLogger("load_json_file")
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError):
+        log.info("Unable to read cached file", extra={"path": str(path)})
+    return None
+
+
+def save_json_file(path, data):
+    # Write to a private temporary file and rename it into place, so concurrent runs
+    # never see a partially written file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def load_keyring_id_client():
+    log = logging.getLogger("load_keyring_id_client")
+    try:
+        saved_client = keyring.get_password(KEYRING_SERVICE, KEYRING_USERNAME)
+        return saved_client and json.loads(saved_client)
+    except (keyring.errors.KeyringError, ValueError):
+        log.info("Unable to read ID client from keyring")
+        return None
+
+
 def register_id_client(oidc_client):
     log = logging.getLogger("register_id_client")
-    keyring_service, keyring_username = "aws-sso-oidc", "sso-config-generator"
-    saved_client = keyring.get_password(keyring_service, keyring_username)
-    id_client = saved_client and json.loads(saved_client)
-    if not validate_id_client(id_client):
-        log.info("Registering a new ID client")
-        id_client = oidc_client.register_client(clientName=keyring_username, clientType="public")
-        keyring.set_password(
-            keyring_service,
-            keyring_username,
-            json.dumps(
-                {
-                    k: id_client[k]
-                    for k in (
-                        "clientId",
-                        "clientSecret",
-                        "clientSecretExpiresAt",
-                        "clientIdIssuedAt",
-                    )
-                }
-            ),
-        )
-    else:
+
+    # Earlier versions saved the ID client in the system keyring. Only fall back to it
+    # when there's no usable client file, to skip the keyring round trip on most runs.
+    id_client = load_json_file(ID_CLIENT_PATH)
+    if validate_id_client(id_client):
         log.info("Using cached ID client")
+        return id_client
 
+    id_client = load_keyring_id_client()
+    if validate_id_client(id_client):
+        log.info("Using ID client from keyring")
+    else:
+        log.info("Registering a new ID client")
+        id_client = oidc_client.register_client(clientName=CLIENT_NAME, clientType="public")
+
+    save_json_file(
+        ID_CLIENT_PATH,
+        {
+            k: id_client[k]
+            for k in (
+                "clientId",
+                "clientSecret",
+                "clientSecretExpiresAt",
+                "clientIdIssuedAt",
+            )
+            if k in id_client
+        },
+    )
     return id_client
 
 
-def create_access_token(oidc_client, id_client, sso_start_url):
+def sso_cache_path(cache_key):
+    # Match the AWS CLI's token cache layout, which keys entries on the sso-session
+    # name or (for legacy profiles) the start URL
+    cache_hash = hashlib.sha1(cache_key.encode("utf-8")).hexdigest()  # noqa: S324
+    return SSO_CACHE_DIR / f"{cache_hash}.json"
+
+
+def token_expires_after(cached_token, key, delta):
+    try:
+        expires = datetime.fromisoformat(cached_token[key])
+        return expires > (datetime.now(UTC) + delta)
+    except (KeyError, TypeError, ValueError):
+        return False
+
+
+def validate_cached_token(cached_token):
+    if not cached_token or "accessToken" not in cached_token:
+        return False
+    return token_expires_after(cached_token, "expiresAt", timedelta(minutes=5))
+
+
+def find_cached_token(sso_session_name, sso_start_url):
+    log = logging.getLogger("find_cached_token")
+
+    # Prefer a token shared with `aws sso login --sso-session <name>`, but fall back to
+    # one from a legacy profile login against the same start URL
+    candidates = [
+        cached_token
+        for cached_token in (
+            load_json_file(sso_cache_path(sso_session_name)),
+            load_json_file(sso_cache_path(sso_start_url)),
+        )
+        if cached_token and cached_token.get("startUrl") == sso_start_url
+    ]
+    for cached_token in candidates:
+        if validate_cached_token(cached_token):
+            log.info("Using cached access token")
+            return cached_token
+    return candidates[0] if candidates else None
+
+
+def refresh_access_token(oidc_client, cached_token):
+    log = logging.getLogger("refresh_access_token")
+
+    required_keys = {"refreshToken", "clientId", "clientSecret"}
+    if not cached_token or not required_keys.issubset(cached_token):
+        return None
+    if not token_expires_after(cached_token, "registrationExpiresAt", timedelta(0)):
+        return None
+
+    log.info("Refreshing cached access token")
+    try:
+        return oidc_client.create_token(
+            clientId=cached_token["clientId"],
+            clientSecret=cached_token["clientSecret"],
+            grantType="refresh_token",
+            refreshToken=cached_token["refreshToken"],
+        )
+    except oidc_client.exceptions.ClientError:
+        log.info("Unable to refresh cached access token")
+        return None
+
+
+def authorize_device(oidc_client, id_client, sso_start_url):
     device_auth = oidc_client.start_device_authorization(
         clientId=id_client["clientId"],
         clientSecret=id_client["clientSecret"],
@@ -95,30 +227,77 @@ def create_access_token(oidc_client, id_client, sso_start_url):
     )
     webbrowser.open_new_tab(device_auth["verificationUriComplete"])
 
+    poll_interval = device_auth.get("interval", 5)
     with progress:
         auth_task = progress.add_task("Waiting for device authorization...", total=None)
-        while not progress.finished:
+        while True:
             try:
-                access_token = oidc_client.create_token(
+                token = oidc_client.create_token(
                     clientId=id_client["clientId"],
                     clientSecret=id_client["clientSecret"],
                     grantType="urn:ietf:params:oauth:grant-type:device_code",
                     deviceCode=device_auth["deviceCode"],
-                )["accessToken"]
+                )
                 progress.update(auth_task, total=100, completed=100)
+                break
             except oidc_client.exceptions.AuthorizationPendingException:
-                time.sleep(5)
+                time.sleep(poll_interval)
+            except oidc_client.exceptions.SlowDownException:
+                # Per RFC 8628, back off by 5 seconds for this and all subsequent polls
+                poll_interval += 5
+                time.sleep(poll_interval)
+
+    return token
 
-    return access_token
+
+def create_access_token(oidc_client, id_client, sso_session_name, sso_start_url, force_refresh=False):
+    log = logging.getLogger("create_access_token")
+    cache_path = sso_cache_path(sso_session_name)
+
+    if force_refresh:
+        log.info("Skipping cached access tokens")
+        cached_token = None
+    else:
+        cached_token = find_cached_token(sso_session_name, sso_start_url)
+        if validate_cached_token(cached_token):
+            return cached_token["accessToken"]
+
+    token = refresh_access_token(oidc_client, cached_token)
+    if token:
+        # A refreshed token stays tied to the client registration that issued it
+        client = {k: cached_token[k] for k in ("clientId", "clientSecret", "registrationExpiresAt")}
+    else:
+        token = authorize_device(oidc_client, id_client, sso_start_url)
+        client = {
+            "clientId": id_client["clientId"],
+            "clientSecret": id_client["clientSecret"],
+            "registrationExpiresAt": datetime.fromtimestamp(id_client["clientSecretExpiresAt"], UTC).strftime(
+                SSO_CACHE_TIME_FORMAT
+            ),
+        }
+
+    expires_at = datetime.now(UTC) + timedelta(seconds=token["expiresIn"])
+    new_token = {
+        "startUrl": sso_start_url,
+        "region": oidc_client.meta.region_name,
+        "accessToken": token["accessToken"],
+        "expiresAt": expires_at.strftime(SSO_CACHE_TIME_FORMAT),
+        **client,
+    }
+    if token.get("refreshToken"):
+        new_token["refreshToken"] = token["refreshToken"]
+    save_json_file(cache_path, new_token)
+
+    return token["accessToken"]
 
 
 def list_accounts(sso_client, access_token):
-    with progress:
-        list_accounts_task = progress.add_task("Listing accounts...", total=None)
+    list_accounts_task = progress.add_task("Listing accounts...", total=None)
 
-        paginator = sso_client.get_paginator("list_accounts")
-        accounts = [acc for page in paginator.paginate(accessToken=access_token) for acc in page["accountList"]]
-        progress.update(list_accounts_task, total=100, completed=100)
+    paginator = sso_client.get_paginator("list_accounts")
+    pages = paginator.paginate(accessToken=access_token, PaginationConfig={"PageSize": SSO_LIST_PAGE_SIZE})
+    accounts = [acc for page in pages for acc in page["accountList"]]
+    progress.update(list_accounts_task, total=100, completed=100)
     return accounts
 
 
@@ -127,102 +306,212 @@ def get_roles(account, sso_client, access_token):
     return {
         account["accountName"]: [
             role
-            for page in paginator.paginate(accessToken=access_token, accountId=account["accountId"])
+            for page in paginator.paginate(
+                accessToken=access_token,
+                accountId=account["accountId"],
+                PaginationConfig={"PageSize": SSO_LIST_PAGE_SIZE},
+            )
             for role in page["roleList"]
         ]
     }
 
 
-def list_account_roles(sso_client, access_token, accounts):
+def list_account_roles(sso_client, access_token, accounts, executor):
     account_roles = {}
-    with progress:
-        task = progress.add_task("Listing roles for accounts...", total=len(accounts))
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            futures = [executor.submit(get_roles, account, sso_client, access_token) for account in accounts]
+    task = progress.add_task("Listing roles for accounts...", total=len(accounts))
+    futures = [executor.submit(get_roles, account, sso_client, access_token) for account in accounts]
 
-            for future in as_completed(futures):
-                account_roles.update(future.result())
-                progress.advance(task)
+    for future in as_completed(futures):
+        account_roles.update(future.result())
+        progress.advance(task)
     return account_roles
 
 
-def munge_profile_name(account_name, role_name, regex_replacements):
-    replacements = ChainMap(
-        regex_replacements or {},
-        {
-            "_": "-",
-            " ": "-",
-        },
-    )
+def literal_pattern(pattern, replacement):
+    # A pattern without metacharacters or flags only ever matches its own text, and a
+    # replacement without backslashes is inserted as-is, so str methods can stand in
+    # for the regex engine
+    if isinstance(pattern, re.Pattern):
+        if pattern.flags != re.UNICODE:
+            return None
+        pattern = pattern.pattern
+    if not pattern or "\\" in replacement or REGEX_METACHARACTERS.intersection(pattern):
+        return None
+    return pattern
+
+
+def compile_replacements(regex_replacements):
+    # User-supplied replacements (as strings or compiled patterns) override the defaults
+    # in place; new patterns run after them
+    replacements = {}
+    for pattern, replacement in chain(DEFAULT_REPLACEMENTS.items(), (regex_replacements or {}).items()):
+        replacements[getattr(pattern, "pattern", pattern)] = (pattern, replacement)
+
+    # Leading single-character literal replacements (the defaults, unless overridden)
+    # can be applied in a single str.translate() pass. Stop at the first replacement
+    # that can't, to keep the same order of operations. Other literal replacements use
+    # str.replace(), and only real regular expressions are compiled.
+    translations = {}
+    substitutions = []
+    for pattern, replacement in replacements.values():
+        literal = literal_pattern(pattern, replacement)
+        if (
+            not substitutions
+            and literal is not None
+            and len(literal) == 1
+            and literal not in "".join(translations.values())
+        ):
+            translations[ord(literal)] = replacement
+        elif literal is not None:
+            substitutions.append((literal, replacement))
+        else:
+            substitutions.append((re.compile(pattern), replacement))
+
+    return translations, substitutions
+
+
+def apply_substitutions(profile_name, substitutions):
+    for pattern, replacement in substitutions:
+        if isinstance(pattern, str):
+            profile_name = profile_name.replace(pattern, replacement)
+        else:
+            profile_name = pattern.sub(replacement, profile_name)
+    return profile_name
 
-    profile_name = f"{account_name}-{role_name}"
-    for old, new in replacements.items():
-        profile_name = re.sub(old, new, profile_name)
 
-    return profile_name
+def munge_profile_name(account_name, role_name, regex_replacements):
+    translations, substitutions = compile_replacements(regex_replacements)
+    return apply_substitutions(f"{account_name}-{role_name}".translate(translations), substitutions)
 
 
 def build_config_profiles(account_roles, regex_replacements):
+    translations, substitutions = compile_replacements(regex_replacements)
+
+    # Character translations don't depend on their surroundings, so translate each
+    # account name once for all of its roles. Other replacements can match across
+    # the account and role names, so those still run on each full profile name.
+    account_prefixes = {account_name: f"{account_name}-".translate(translations) for account_name in account_roles}
+
+    rows = sorted(
+        (account_name, role["roleName"], role["accountId"])
+        for account_name, roles in account_roles.items()
+        for role in roles
+    )
     return [
         {
-            "name": munge_profile_name(account_name, role["roleName"], regex_replacements),
+            "name": apply_substitutions(
+                account_prefixes[account_name] + role_name.translate(translations),
+                substitutions,
+            ),
             "account_name": account_name,
-            "role_name": role["roleName"],
-            "account_id": role["accountId"],
+            "role_name": role_name,
+            "account_id": account_id,
         }
-        for account_name in sorted(account_roles)
-        for role in sorted(account_roles[account_name], key=itemgetter("roleName"))
+        for account_name, role_name, account_id in rows
     ]
 
 
 def format_profile(template, profile, sso_session_name, **extra_vars):
-    return textwrap.dedent(
-        template.format(
-            profile_name=profile["name"],
-            account_name=profile["account_name"],
-            account_id=profile["account_id"],
-            role_name=profile["role_name"],
-            sso_session=sso_session_name,
-            **extra_vars,
-        )
+    return template.format(
+        profile_name=profile["name"],
+        account_name=profile["account_name"],
+        account_id=profile["account_id"],
+        role_name=profile["role_name"],
+        sso_session=sso_session_name,
+        **extra_vars,
     )
 
 
-def generate_config_blocks(
+def collect_profiles(sso_client, access_token, sso_directory, regex_replacements, role_executor):
+    accounts = list_accounts(sso_client, access_token)
+    account_roles = list_account_roles(sso_client, access_token, accounts, role_executor)
+    return sso_directory, build_config_profiles(account_roles, regex_replacements)
+
+
+def iter_config_blocks(
     sso_directories,
     profile_template=DEFAULT_PROFILE_TEMPLATE,
     regex_replacements=None,
+    max_parallel_requests=None,
+    force_refresh=False,
     **extra_vars,
 ):
+    max_parallel_requests = max_parallel_requests or DEFAULT_MAX_PARALLEL_REQUESTS
+    directory_workers = max(1, min(MAX_PARALLEL_DIRECTORIES, len(sso_directories)))
+
     sess = boto3.Session(region_name="us-east-1")
     oidc_client = sess.client("sso-oidc")
-    sso_client = sess.client("sso", config=Config(retries={"mode": "standard", "max_attempts": 10}))
+    # Size the HTTP connection pool to cover every worker that can make a request at once.
+    # Otherwise urllib3 blocks threads at its default pool size of 10.
+    sso_client = sess.client(
+        "sso",
+        config=Config(
+            retries={"mode": "standard", "max_attempts": 10},
+            max_pool_connections=max_parallel_requests + directory_workers,
+            tcp_keepalive=True,
+            connect_timeout=5,
+            read_timeout=30,
+        ),
+    )
     id_client = register_id_client(oidc_client)
-    config_blocks = []
 
-    for sso_directory in sorted(sso_directories):
-        sso_start_url = f"https://{sso_directory}.awsapps.com/start"
-        access_token = create_access_token(oidc_client, id_client, sso_start_url)
-        accounts = list_accounts(sso_client, access_token)
-        account_roles = list_account_roles(sso_client, access_token, accounts)
-        profiles = build_config_profiles(account_roles, regex_replacements)
+    # Device authorization is interactive, so log in to each directory up front
+    # and only fan out the account/role listing calls
+    start_urls = {sso_directory: f"https://{sso_directory}.awsapps.com/start" for sso_directory in sso_directories}
+    access_tokens = {
+        sso_directory: create_access_token(oidc_client, id_client, sso_directory, sso_start_url, force_refresh)
+        for sso_directory, sso_start_url in sorted(start_urls.items())
+    }
 
-        config_blocks.append(
-            textwrap.dedent(SSO_SESSION_BLOCK.format(sso_session_name=sso_directory, sso_start_url=sso_start_url))
-        )
-        config_blocks.extend(
-            [
-                format_profile(
-                    textwrap.dedent(profile_template),
-                    profile,
-                    sso_directory,
-                    **extra_vars,
-                )
-                for profile in profiles
-            ]
-        )
+    # Role listing for every directory shares one pool, so max_parallel_requests caps
+    # the total number of in-flight requests rather than the number per directory
+    directory_profiles = {}
+    role_executor = ThreadPoolExecutor(max_workers=max_parallel_requests)
+    with progress, role_executor, ThreadPoolExecutor(max_workers=directory_workers) as executor:
+        futures = [
+            executor.submit(
+                collect_profiles,
+                sso_client,
+                access_token,
+                sso_directory,
+                regex_replacements,
+                role_executor,
+            )
+            for sso_directory, access_token in access_tokens.items()
+        ]
+        for future in as_completed(futures):
+            sso_directory, profiles = future.result()
+            directory_profiles[sso_directory] = profiles
+
+    # Custom templates may be indented to match the code that defines them
+    profile_template = textwrap.dedent(profile_template)
+    for sso_directory in sorted(directory_profiles):
+        sso_start_url = start_urls[sso_directory]
+        profiles = directory_profiles[sso_directory]
 
-    return "".join(config_blocks)
+        yield SSO_SESSION_BLOCK.format(sso_session_name=sso_directory, sso_start_url=sso_start_url)
+        for profile in profiles:
+            yield format_profile(profile_template, profile, sso_directory, **extra_vars)
+
+
+def generate_config_blocks(
+    sso_directories,
+    profile_template=DEFAULT_PROFILE_TEMPLATE,
+    regex_replacements=None,
+    max_parallel_requests=None,
+    force_refresh=False,
+    **extra_vars,
+):
+    return "".join(
+        iter_config_blocks(
+            sso_directories,
+            profile_template,
+            regex_replacements,
+            max_parallel_requests=max_parallel_requests,
+            force_refresh=force_refresh,
+            **extra_vars,
+        )
+    )
 
 
 def validate_extras(ctx, param, value):  # noqa: ARG001
@@ -233,10 +522,19 @@ def validate_extras(ctx, param, value):  # noqa: ARG001
 
 
 def validate_replacements(ctx, param, value):  # noqa: ARG001
+    replacements = {}
     for v in value:
         if v.count(",") != 1:
             raise click.BadParameter(VALIDATION_FAIL_REPLACEMENTS.format(value=v))
-    return dict(v.split(",") for v in value)
+        pattern, replacement = v.split(",")
+        try:
+            compiled = re.compile(pattern)
+            # Substituting into an empty string still checks the replacement's group references
+            compiled.sub(replacement, "")
+        except (re.error, IndexError) as e:
+            raise click.BadParameter(VALIDATION_FAIL_REGEX.format(value=v, error=e)) from e
+        replacements[compiled] = replacement
+    return replacements
 
 
 @click.command(context_settings={"help_option_names": ["-h", "--help"]}, no_args_is_help=True)
@@ -288,12 +586,34 @@ def validate_replacements(ctx, param, value):  # noqa: ARG001
     callback=validate_replacements,
     help="Regex replacements to perform on generated profile names, in the form 'pattern,replacement'",
 )
-def cli(sso_directories, profile_template, regex_replacements, extra_vars):
+@click.option(
+    "--max-parallel-requests",
+    "-p",
+    type=click.IntRange(min=1),
+    help="""
+        Maximum number of concurrent requests to make when listing roles.
+        Defaults to 5 per CPU, up to 32.
+    """,
+)
+@click.option(
+    "--force-refresh",
+    is_flag=True,
+    help="Log in to each SSO directory even if a cached access token is still valid",
+)
+def cli(sso_directories, profile_template, regex_replacements, max_parallel_requests, force_refresh, extra_vars):
     logging.basicConfig(level=logging.INFO)
 
-    print(  # noqa: T201
-        generate_config_blocks(sso_directories, profile_template, regex_replacements, **extra_vars)
+    sys.stdout.writelines(
+        iter_config_blocks(
+            sso_directories,
+            profile_template,
+            regex_replacements,
+            max_parallel_requests=max_parallel_requests,
+            force_refresh=force_refresh,
+            **extra_vars,
+        )
     )
+    sys.stdout.write("\n")
 
 
 text_column = TextColumn("{task.description}", table_column=Column(width=40))